@@ -1,11 +1,18 @@
 ﻿from __future__ import annotations
-import json, csv, re
+import asyncio, json, csv, math, random, re, time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, Any, List
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
-import yaml  # pip install pyyaml
-from prompt_lab.genai_client import GeminiClient
-from google.genai import types
+from prompt_lab.genai_client import GeminiClient, usage_metrics
+from prompt_lab.loaders import load_json, load_yaml
+from prompt_lab.templates import fewshot_block
+from google.genai import errors
 
 # --- Paths / setup ---
 ROOT = Path(__file__).resolve().parents[1]
@@ -17,14 +24,22 @@ ARTIFACTS.mkdir(exist_ok=True)
 
 # --- Helpers ---
 def load_variants() -> Dict[str, Any]:
-    # Use utf-8-sig to tolerate BOM on Windows
-    return yaml.safe_load(VARIANTS.read_text(encoding="utf-8-sig"))
+    # Parsed once per file change; tolerates a BOM on Windows
+    return load_yaml(VARIANTS)
+
+
+def load_cases() -> List[Dict[str, Any]]:
+    return load_json(CASES)
 
 
 def render_prompt(variant: Dict[str, Any], case: Dict[str, Any]) -> Dict[str, Any]:
     """
     Returns: {"prompt": str, "system": Optional[str], "mime": Optional[str]}
     Expands few_shots inline in a simple "User/Assistant" format for demo purposes.
+
+    The few-shot block goes first so every case of a variant shares a
+    byte-identical prefix (system instruction + examples), which Gemini's
+    implicit context caching can reuse; only the templated turn differs.
     """
     sys = variant.get("system")
     tmpl = variant["prompt_template"]
@@ -33,31 +48,42 @@ def render_prompt(variant: Dict[str, Any], case: Dict[str, Any]) -> Dict[str, An
     # Inline few-shot examples if present
     shots = variant.get("few_shots", [])
     if shots:
-        lines = []
-        for s in shots:
-            lines.append(f"User: {s['user']}\nAssistant: {s['model']}")
-        fewshot_block = "\n\n".join(lines)
-        prompt = (
-            f"{fewshot_block}\n\n"
-            f"User: {case.get('task','')}\n{case.get('input','')}\n"
-            f"Assistant:"
-        )
+        prompt = f"{fewshot_block(shots)}\n\nUser: {prompt}\nAssistant:"
 
     return {"prompt": prompt, "system": sys, "mime": variant.get("response_mime_type")}
 
 
 # --- Scoring ---
-def score_summarize(output: str, case: Dict[str, Any]) -> Dict[str, Any]:
-    words = len(output.split())
-    max_words = int(case.get("max_words", 9999))
+_LABEL_RE = re.compile(r"(Positive|Neutral|Negative)", re.I)
+
+
+@lru_cache(maxsize=None)
+def _keyword_pattern(kw: str) -> "re.Pattern[str]":
+    return re.compile(re.escape(kw), re.I)
+
+
+def _keyword_hits(output: str, kws: List[str]) -> int:
+    # One precompiled literal search per keyword: each stops at its first hit and
+    # keeps re's fast literal scan, which beats a fused re.I alternation here
+    return sum(1 for k in kws if _keyword_pattern(k).search(output))
+
+
+def _summary_scores(words: int, max_words: int, hits: int, n_kws: int) -> Tuple[float, float]:
+    """Numeric half of score_summarize: counts in, (length, keyword) scores out."""
     # length score: 1.0 if within limit, linear penalty if over
     s_len = 1.0 if words <= max_words else max(0.0, 1 - (words - max_words) / max_words)
+    s_keys = hits / n_kws if n_kws else 0.0
+    return s_len, s_keys
 
+
+def score_summarize(output: str, case: Dict[str, Any]) -> Dict[str, Any]:
+    # All string work (tokenizing, keyword scan) happens here, once per output
+    words = len(output.split())
+    max_words = int(case.get("max_words", 9999))
     kws = case.get("keywords") or []
-    s_keys = 0.0
-    if kws:
-        hits = sum(1 for k in kws if re.search(re.escape(k), output, re.I))
-        s_keys = hits / len(kws)
+    hits = _keyword_hits(output, kws) if kws else 0
+
+    s_len, s_keys = _summary_scores(words, max_words, hits, len(kws))
 
     return {
         "words": words,
@@ -72,7 +98,7 @@ def score_classify(output: str, case: Dict[str, Any]) -> Dict[str, Any]:
     try:
         parsed = json.loads(output)
     except Exception:
-        m = re.search(r"(Positive|Neutral|Negative)", output, re.I)
+        m = _LABEL_RE.search(output)
         if m:
             parsed = {"label": m.group(1).capitalize(), "confidence": None}
 
@@ -84,72 +110,221 @@ def score_classify(output: str, case: Dict[str, Any]) -> Dict[str, Any]:
     return {"ok_json": ok_json, "label": label, "score_label": match}
 
 
+# --- Model calls ---
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 6
+MAX_BACKOFF_S = 60.0  # per-minute quotas need waits of up to a minute
+
+
+def _is_rate_limited(exc: Exception) -> bool:
+    return isinstance(exc, errors.APIError) and exc.code == 429
+
+
+def _retry_after(exc: Exception) -> Optional[float]:
+    """Seconds from the 429's Retry-After header (delta-seconds or HTTP date), if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    value = headers.get("retry-after") if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:  # "-0000" dates parse as naive UTC
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _timed(fn, *args, **kwargs) -> Tuple[Any, float]:
+    # Runs inside the worker thread, so time spent queued for a thread isn't counted
+    t0 = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - t0
+
+
+async def _with_retry(fn, *args, **kwargs) -> Tuple[Any, float]:
+    """
+    Run a blocking SDK call in a thread, backing off on 429s.
+    Returns (result, seconds taken by the successful attempt).
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return await asyncio.to_thread(_timed, fn, *args, **kwargs)
+        except Exception as e:
+            if not _is_rate_limited(e) or attempt == MAX_RETRIES - 1:
+                raise
+            # the server's Retry-After wins; else exponential backoff with full jitter
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, 2 ** (attempt + 1))
+            await asyncio.sleep(min(delay, MAX_BACKOFF_S))
+
+
+def _drain(stream_fn: Callable[..., Iterable[Any]]) -> Callable[..., Any]:
+    """Turn a streaming call into a blocking one returning a response-like object."""
+    def call(*args, **kwargs):
+        parts: List[str] = []
+        usage = None
+        cache_hit = False
+        for chunk in stream_fn(*args, **kwargs):
+            parts.append(chunk.text or "")
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            cache_hit = cache_hit or getattr(chunk, "cache_hit", False)
+        return SimpleNamespace(text="".join(parts), usage_metadata=usage, cache_hit=cache_hit)
+    return call
+
+
+async def _call_one(
+    client: GeminiClient,
+    v: Dict[str, Any],
+    case: Dict[str, Any],
+    temp: float,
+    max_tok: int,
+    stream: bool = False,
+) -> Dict[str, Any]:
+    vid = v["id"]
+    rendered = render_prompt(v, case)
+
+    # Streaming doesn't speed up a batch run, but is handy to exercise that path
+    generate = _drain(client.generate_stream) if stream else client.generate
+
+    # JSON-only variants set response_mime_type
+    resp, latency = await _with_retry(
+        generate,
+        rendered["prompt"],
+        system_instruction=rendered["system"],
+        temperature=temp,
+        max_output_tokens=max_tok,
+        response_mime_type=rendered["mime"],
+    )
+    text = resp.text
+
+    result: Dict[str, Any] = {
+        "variant": vid,
+        "case_id": case["id"],
+        "type": case["type"],
+        "output": (text or "").strip(),
+        "latency_ms": round(latency * 1000, 1),
+        **usage_metrics(resp),
+    }
+
+    if case["type"] == "summarize":
+        result.update(score_summarize(text, case))
+        result["total_score"] = round(
+            (result["score_len"] + result["score_keywords"]) / 2, 3
+        )
+    elif case["type"] == "classify":
+        result.update(score_classify(text, case))
+        result["total_score"] = round(
+            (result["ok_json"] + result["score_label"]) / 2, 3
+        )
+
+    print(
+        f"[{vid} -> {case['id']}] total={result.get('total_score')} "
+        f"latency={result['latency_ms']}ms"
+    )
+    return result
+
+
+async def _run(tasks: List[Awaitable[Dict[str, Any]]], limit: int) -> List[Any]:
+    # to_thread() runs on the default executor, which is capped at
+    # min(32, cpu_count + 4) threads; size it to the limit so it really applies
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=limit))
+    sem = asyncio.Semaphore(limit)
+
+    async def bounded(t: Awaitable[Dict[str, Any]]) -> Dict[str, Any]:
+        async with sem:
+            return await t
+
+    return await asyncio.gather(*(bounded(t) for t in tasks), return_exceptions=True)
+
+
+def _percentile(sorted_vals: List[float], pct: float) -> float:
+    # nearest-rank percentile; fine for the handful of calls in a sweep
+    idx = max(0, math.ceil(pct / 100 * len(sorted_vals)) - 1)
+    return sorted_vals[idx]
+
+
+def summarize_metrics(rows: List[Dict[str, Any]], defaults: Dict[str, Any]) -> None:
+    """Print latency percentiles, token totals and (if priced) estimated cost."""
+    if not rows:
+        return
+    rows = [r for r in rows if "error" not in r]
+    if not rows:
+        return
+    lat = sorted(r["latency_ms"] for r in rows)
+    t_in = sum(r.get("prompt_tokens") or 0 for r in rows)
+    t_out = sum(r.get("output_tokens") or 0 for r in rows)
+    hits = sum(1 for r in rows if r.get("cache_hit"))
+
+    print(
+        f"\nLatency ms: p50={_percentile(lat, 50)} p95={_percentile(lat, 95)} "
+        f"p99={_percentile(lat, 99)} (n={len(lat)})"
+    )
+    print(f"Tokens: prompt={t_in} output={t_out} | prompt-cache hits: {hits}/{len(rows)}")
+
+    # Prices are per million tokens; set them under defaults to get a cost estimate
+    p_in, p_out = defaults.get("price_per_mtok_input"), defaults.get("price_per_mtok_output")
+    if p_in is not None and p_out is not None:
+        billed = [r for r in rows if not r.get("cache_hit")]  # local hits never reach the API
+        b_in = sum(r.get("prompt_tokens") or 0 for r in billed)
+        b_out = sum(r.get("output_tokens") or 0 for r in billed)
+        cost = (b_in * float(p_in) + b_out * float(p_out)) / 1_000_000
+        print(f"Estimated cost: ${cost:.4f}")
+
+
 # --- Main ---
 def main():
     cfg = load_variants()
     defaults = cfg.get("defaults", {})
     variants = cfg.get("variants", [])
 
-    # Read JSON with utf-8-sig to strip BOM if present
-    cases_text = CASES.read_text(encoding="utf-8-sig")
-    cases = json.loads(cases_text)
+    cases = load_cases()
 
     client = GeminiClient(model=defaults.get("model", None))
 
+    temp = float(defaults.get("temperature", 0.7))
+    max_tok = int(defaults.get("max_output_tokens", 256))
+    limit = int(defaults.get("concurrency", MAX_CONCURRENCY))
+    if limit < 1:
+        raise SystemExit(f"defaults.concurrency must be >= 1, got {limit}")
+    stream = bool(defaults.get("stream", False))
+
+    # Bucket cases by type once; each variant then only walks the types it applies to
+    cases_by_type: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    for case in cases:
+        cases_by_type[case["type"]].append(case)
+
+    jobs = [
+        (v, case)
+        for v in variants
+        # dict.fromkeys de-dupes applies_to while keeping its order
+        for t in dict.fromkeys(v.get("applies_to", ["summarize", "classify"]))
+        for case in cases_by_type.get(t, ())
+    ]
+    tasks = [_call_one(client, v, case, temp, max_tok, stream) for v, case in jobs]
+    outcomes = asyncio.run(_run(tasks, limit))
+
+    # gather() preserves submission order, so rows stay variant-major
+    # failed calls stay in the artifacts as rows with an "error" column
     rows: List[Dict[str, Any]] = []
-    for v in variants:
-        vid = v["id"]
-        allowed = set(v.get("applies_to", ["summarize", "classify"]))
-        for case in cases:
-            if case["type"] not in allowed:
-                continue
-            rendered = render_prompt(v, case)
-
-            temp = float(defaults.get("temperature", 0.7))
-            max_tok = int(defaults.get("max_output_tokens", 256))
-
-            # If variant requests JSON-only, set response_mime_type
-            if rendered["mime"]:
-                resp = client.client.models.generate_content(
-                    model=client.model,
-                    contents=rendered["prompt"],
-                    config=types.GenerateContentConfig(
-                        response_mime_type=rendered["mime"],
-                        system_instruction=v.get("system"),
-                        temperature=temp,
-                        max_output_tokens=max_tok,
-                    ),
-                )
-                text = resp.text
-            else:
-                resp = client.generate_text(
-                    rendered["prompt"],
-                    system_instruction=v.get("system"),
-                    temperature=temp,
-                    max_output_tokens=max_tok,
-                )
-                text = resp.text
-
-            result: Dict[str, Any] = {
-                "variant": vid,
+    failed = 0
+    for (v, case), out in zip(jobs, outcomes):
+        if isinstance(out, BaseException):
+            print(f"[{v['id']} -> {case['id']}] FAILED: {out!r}")
+            failed += 1
+            out = {
+                "variant": v["id"],
                 "case_id": case["id"],
                 "type": case["type"],
-                "output": (text or "").strip(),
+                "output": "",
+                "error": repr(out),
             }
-
-            if case["type"] == "summarize":
-                result.update(score_summarize(text, case))
-                result["total_score"] = round(
-                    (result["score_len"] + result["score_keywords"]) / 2, 3
-                )
-            elif case["type"] == "classify":
-                result.update(score_classify(text, case))
-                result["total_score"] = round(
-                    (result["ok_json"] + result["score_label"]) / 2, 3
-                )
-
-            rows.append(result)
-            print(f"[{vid} -> {case['id']}] total={result.get('total_score')}")
+        rows.append(out)
 
     # --- CSV (handle heterogeneous rows by using union of keys) ---
     out_csv = ARTIFACTS / "results.csv"
@@ -158,19 +333,21 @@ def main():
     fieldnames = core + metrics
 
     with out_csv.open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        # restval fills metrics a row doesn't have, so rows go out in one pass
+        w = csv.DictWriter(f, fieldnames=fieldnames, restval="", extrasaction="ignore")
         w.writeheader()
-        for r in rows:
-            for k in fieldnames:
-                r.setdefault(k, "")
-            w.writerow(r)
+        w.writerows(rows)
 
     # --- JSON ---
     out_json = ARTIFACTS / "results.json"
     out_json.write_text(json.dumps(rows, indent=2), encoding="utf-8")
 
+    summarize_metrics(rows, defaults)
     print(f"\nWrote {out_csv} and {out_json}")
 
+    if failed:
+        raise SystemExit(f"{failed}/{len(rows)} calls failed (see the 'error' column)")
+
 
 if __name__ == "__main__":
     main()
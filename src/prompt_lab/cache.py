@@ -0,0 +1,85 @@
+from __future__ import annotations
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Resolve repo root:  .../src/prompt_lab/cache.py -> parents[2] = repo root
+ROOT = Path(__file__).resolve().parents[2]
+
+DEFAULT_PATH = ROOT / "artifacts" / ".promptcache" / "cache.sqlite3"
+
+
+def cache_enabled(temperature: Optional[float]) -> bool:
+    """
+    Only deterministic calls are cached by default; sampling at temperature > 0
+    is supposed to vary. Set GEMINIPL_CACHE_FORCE=1 to cache everything.
+    """
+    if os.getenv("GEMINIPL_CACHE_FORCE") == "1":
+        return True
+    return temperature == 0.0
+
+
+class PromptCache:
+    """
+    Exact-match response cache keyed on everything that shapes a generation:
+    model, system instruction, prompt, temperature, max tokens and mime type.
+
+    Backed by a single sqlite file so it survives across eval runs and
+    Streamlit reruns, and is safe to hit from worker threads.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        # Nothing touches disk until the first cacheable call: most calls run at
+        # temperature > 0 and the package may be installed somewhere read-only
+        self.path = Path(path or DEFAULT_PATH)
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        with self._lock:
+            if not self._ready:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                with closing(sqlite3.connect(self.path, timeout=30)) as db, db:
+                    db.execute(
+                        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+                    )
+                self._ready = True
+        # One short-lived connection per operation keeps threads independent
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def make_key(
+        *,
+        model: str,
+        system: Optional[str],
+        prompt: str,
+        temperature: Optional[float],
+        max_output_tokens: Optional[int],
+        mime: Optional[str],
+    ) -> str:
+        payload = {
+            "model": model,
+            "system": system,
+            "prompt": prompt,
+            "temperature": temperature,
+            "max_output_tokens": max_output_tokens,
+            "mime": mime,
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with closing(self._connect()) as db, db:
+            row = db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: Dict[str, Any]) -> None:
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, value) VALUES (?, ?)",
+                (key, json.dumps(value)),
+            )
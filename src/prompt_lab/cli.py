@@ -50,7 +50,7 @@ def run(
         tokens = client.count_tokens(prompt_text)
         console.print(f"[dim]Prompt tokens: {tokens}[/dim]")
 
-    resp = client.generate_text(
+    resp = client.generate(
         prompt_text,
         system_instruction=system_text,
         temperature=temp,
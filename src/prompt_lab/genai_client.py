@@ -1,12 +1,17 @@
 from __future__ import annotations
 import os
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import Optional
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
 
+from .cache import PromptCache, cache_enabled
+
 # Resolve repo root:  .../src/prompt_lab/genai_client.py -> parents[2] = repo root
 ROOT = Path(__file__).resolve().parents[2]
 
@@ -15,6 +20,8 @@ load_dotenv(ROOT / ".env", override=False)
 
 DEFAULT_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
 
+TOKEN_COUNT_CACHE_SIZE = 4096
+
 
 def _get_api_key(passed: Optional[str]) -> str:
     if passed:
@@ -29,39 +36,171 @@ def _get_api_key(passed: Optional[str]) -> str:
     return key
 
 
+def usage_metrics(resp: Any) -> Dict[str, Any]:
+    """
+    Token usage for a response (or final stream chunk) in flat form.
+    cache_hit is our on-disk prompt cache; cached_tokens is Gemini's own
+    implicit/explicit context cache.
+    """
+    usage = getattr(resp, "usage_metadata", None)
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "output_tokens": getattr(usage, "candidates_token_count", None),
+        "cached_tokens": getattr(usage, "cached_content_token_count", None) or 0,
+        "cache_hit": bool(getattr(resp, "cache_hit", False)),
+    }
+
+
 class GeminiClient:
     """
     Thin wrapper around google-genai Client with:
     - .env loading from repo root
     - explicit API key passing
-    - simple text generation + token counting
+    - simple text generation (blocking or streamed) + token counting
+    - an on-disk response cache for deterministic (temperature 0) calls
     """
 
-    def __init__(self, api_key: Optional[str] = None, model: Optional[str] = None):
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None,
+        cache: Optional[PromptCache] = None,
+    ):
         key = _get_api_key(api_key)
         self.client = genai.Client(api_key=key)
         self.model = model or DEFAULT_MODEL
+        self.cache = cache or PromptCache()
+        # Bounded LRU: the Streamlit client is shared by every session for the process lifetime
+        self._token_counts: OrderedDict[str, int] = OrderedDict()
+        self._token_lock = threading.Lock()
+
+    def _cache_key(self, contents: str, config: types.GenerateContentConfig) -> str:
+        return PromptCache.make_key(
+            model=self.model,
+            system=config.system_instruction,
+            prompt=contents,
+            temperature=config.temperature,
+            max_output_tokens=config.max_output_tokens,
+            mime=config.response_mime_type,
+        )
+
+    @staticmethod
+    def _from_cache(hit: Dict[str, Any]) -> SimpleNamespace:
+        usage = SimpleNamespace(**hit["usage"]) if hit.get("usage") else None
+        return SimpleNamespace(text=hit["text"], usage_metadata=usage, cache_hit=True)
+
+    def _store(self, key: str, text: Optional[str], usage: Any) -> None:
+        # Empty/None text means a blocked or failed generation; don't replay it forever
+        if not text:
+            return
+        self.cache.set(key, {
+            "text": text,
+            "usage": usage.model_dump(mode="json", exclude_none=True) if usage else None,
+        })
+
+    def _generate_content(self, contents: str, config: types.GenerateContentConfig) -> Any:
+        """
+        Same as client.models.generate_content for self.model, but served from
+        the prompt cache when allowed. Cache hits return a namespace exposing
+        .text and .usage_metadata like the SDK response.
+        """
+        if not cache_enabled(config.temperature):
+            return self.client.models.generate_content(
+                model=self.model, contents=contents, config=config
+            )
+
+        key = self._cache_key(contents, config)
+        hit = self.cache.get(key)
+        if hit is not None:
+            return self._from_cache(hit)
+
+        resp = self.client.models.generate_content(
+            model=self.model, contents=contents, config=config
+        )
+        self._store(key, resp.text, getattr(resp, "usage_metadata", None))
+        return resp
+
+    def _generate_content_stream(
+        self, contents: str, config: types.GenerateContentConfig
+    ) -> Iterator[Any]:
+        """
+        Streaming counterpart of _generate_content: yields response chunks
+        (.text, .usage_metadata) as they arrive. A cache hit is yielded as a
+        single chunk; a completed miss is stored once the stream is drained.
+        """
+        if not cache_enabled(config.temperature):
+            yield from self.client.models.generate_content_stream(
+                model=self.model, contents=contents, config=config
+            )
+            return
+
+        key = self._cache_key(contents, config)
+        hit = self.cache.get(key)
+        if hit is not None:
+            yield self._from_cache(hit)
+            return
 
-    def generate_text(
+        parts: List[str] = []
+        usage = None
+        for chunk in self.client.models.generate_content_stream(
+            model=self.model, contents=contents, config=config
+        ):
+            parts.append(chunk.text or "")
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            yield chunk
+        self._store(key, "".join(parts), usage)
+
+    @staticmethod
+    def _config(
+        system_instruction: Optional[str],
+        temperature: float,
+        max_output_tokens: int,
+        response_mime_type: Optional[str],
+    ) -> types.GenerateContentConfig:
+        return types.GenerateContentConfig(
+            temperature=temperature,
+            max_output_tokens=max_output_tokens,
+            system_instruction=system_instruction,
+            response_mime_type=response_mime_type,
+        )
+
+    def generate(
         self,
         prompt: str,
         *,
         system_instruction: Optional[str] = None,
         temperature: float = 0.7,
         max_output_tokens: int = 512,
+        response_mime_type: Optional[str] = None,
     ):
-        cfg = types.GenerateContentConfig(
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-            system_instruction=system_instruction,
-        )
-        return self.client.models.generate_content(
-            model=self.model,
-            contents=prompt,
-            config=cfg,
-        )
+        """Single entry point for blocking generation (pass a mime type for JSON-only)."""
+        cfg = self._config(system_instruction, temperature, max_output_tokens, response_mime_type)
+        return self._generate_content(prompt, cfg)
+
+    def generate_stream(
+        self,
+        prompt: str,
+        *,
+        system_instruction: Optional[str] = None,
+        temperature: float = 0.7,
+        max_output_tokens: int = 512,
+        response_mime_type: Optional[str] = None,
+    ) -> Iterator[Any]:
+        """Streaming counterpart of generate(); yields chunks with .text."""
+        cfg = self._config(system_instruction, temperature, max_output_tokens, response_mime_type)
+        return self._generate_content_stream(prompt, cfg)
 
     def count_tokens(self, contents: str) -> int:
-        return self.client.models.count_tokens(
+        # Token counts for a given model + text never change; skip the round-trip
+        with self._token_lock:
+            if contents in self._token_counts:
+                self._token_counts.move_to_end(contents)
+                return self._token_counts[contents]
+        total = self.client.models.count_tokens(
             model=self.model, contents=contents
-        ).total_tokens
\ No newline at end of file
+        ).total_tokens
+        with self._token_lock:
+            self._token_counts[contents] = total
+            if len(self._token_counts) > TOKEN_COUNT_CACHE_SIZE:
+                self._token_counts.popitem(last=False)
+        return total
\ No newline at end of file
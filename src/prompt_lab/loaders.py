@@ -0,0 +1,34 @@
+from __future__ import annotations
+import json
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Union
+
+import yaml
+
+# libyaml's C loader is ~10x faster; PyYAML builds without it fall back to pure Python
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+@lru_cache(maxsize=32)
+def _load_yaml(path: Path, mtime_ns: int) -> Any:
+    # Bytes let the loader detect UTF-8 and skip a BOM (Windows editors add one)
+    return yaml.load(path.read_bytes(), Loader=SafeLoader)
+
+
+@lru_cache(maxsize=32)
+def _load_json(path: Path, mtime_ns: int) -> Any:
+    # json.loads sniffs the encoding of bytes, BOM included, so no decode pass
+    return json.loads(path.read_bytes())
+
+
+def load_yaml(path: Union[str, Path]) -> Any:
+    """Parse a YAML file once per modification; callers must not mutate the result."""
+    p = Path(path)
+    return _load_yaml(p, p.stat().st_mtime_ns)
+
+
+def load_json(path: Union[str, Path]) -> Any:
+    """Parse a JSON file once per modification; callers must not mutate the result."""
+    p = Path(path)
+    return _load_json(p, p.stat().st_mtime_ns)
@@ -0,0 +1,13 @@
+from __future__ import annotations
+from functools import lru_cache
+from typing import Dict, Iterable, Tuple
+
+
+@lru_cache(maxsize=None)
+def _fewshot_block(pairs: Tuple[Tuple[str, str], ...]) -> str:
+    return "\n\n".join(f"User: {u}\nAssistant: {m}" for u, m in pairs)
+
+
+def fewshot_block(shots: Iterable[Dict[str, str]]) -> str:
+    """Inline few-shot examples as "User/Assistant" turns, built once per shot list."""
+    return _fewshot_block(tuple((s["user"], s["model"]) for s in shots))
@@ -1,20 +1,28 @@
 from __future__ import annotations
+import csv
 import json
+import time
 from io import StringIO
 from pathlib import Path
+from types import SimpleNamespace
 from typing import Dict, Any, List, Optional
 
 import streamlit as st
-import yaml
 import os
-from prompt_lab.genai_client import GeminiClient
-from google.genai import types  # for JSON-only responses
+from prompt_lab.genai_client import GeminiClient, usage_metrics
+from prompt_lab.loaders import load_json, load_yaml
+from prompt_lab.templates import fewshot_block
 
 from dotenv import load_dotenv
 from pathlib import Path
 
-# load .env from the project root no matter the working dir
-load_dotenv(dotenv_path=Path(__file__).with_name(".env"), override=True)
+# load .env from the project root no matter the working dir (once per process,
+# not on every rerun)
+@st.cache_resource(show_spinner=False)
+def load_env() -> bool:
+    return load_dotenv(dotenv_path=Path(__file__).with_name(".env"), override=True)
+
+load_env()
 
 
 # ------------------------------------------------------------------------------
@@ -44,11 +52,16 @@ else:
 # ------------------------------------------------------------------------------
 @st.cache_data(show_spinner=False)
 def load_variants() -> Dict[str, Any]:
-    return yaml.safe_load(VARIANTS.read_text(encoding="utf-8-sig"))
+    return load_yaml(VARIANTS)
 
 @st.cache_data(show_spinner=False)
 def load_cases() -> List[Dict[str, Any]]:
-    return json.loads(CASES.read_text(encoding="utf-8-sig"))
+    return load_json(CASES)
+
+@st.cache_resource(show_spinner=False)
+def get_client(model: Optional[str]) -> GeminiClient:
+    # One client (and its HTTP connection pool) shared across reruns and variants
+    return GeminiClient(model=model)
 
 def render_prompt(variant: Dict[str, Any], case: Dict[str, Any]) -> Dict[str, Optional[str]]:
     sys = variant.get("system")
@@ -57,41 +70,48 @@ def render_prompt(variant: Dict[str, Any], case: Dict[str, Any]) -> Dict[str, Op
 
     shots = variant.get("few_shots", [])
     if shots:
-        lines = []
-        for s in shots:
-            lines.append(f"User: {s['user']}\nAssistant: {s['model']}")
-        fewshot_block = "\n\n".join(lines)
-        prompt = f"{fewshot_block}\n\nUser: {case.get('task','')}\n{case.get('input','')}\nAssistant:"
+        # examples first so the prefix is identical across cases (implicit caching);
+        # the variant's own template fills the final user turn
+        prompt = f"{fewshot_block(shots)}\n\nUser: {prompt}\nAssistant:"
     return {"prompt": prompt, "system": sys, "mime": variant.get("response_mime_type")}
 
 def call_model(variant: Dict[str, Any], case: Dict[str, Any], temp: float, max_tok: int, client: GeminiClient):
     rendered = render_prompt(variant, case)
-    if rendered["mime"]:
-        resp = client.client.models.generate_content(
-            model=client.model,
-            contents=rendered["prompt"],
-            config=types.GenerateContentConfig(
-                response_mime_type=rendered["mime"],
-                system_instruction=variant.get("system"),
-                temperature=temp,
-                max_output_tokens=max_tok,
-            ),
-        )
-        text = resp.text
-    else:
-        resp = client.generate_text(
-            rendered["prompt"],
-            system_instruction=variant.get("system"),
-            temperature=temp,
-            max_output_tokens=max_tok,
-        )
-        text = resp.text
-
-    # token stats (prompt + output)
-    try: t_prompt = client.count_tokens(rendered["prompt"])
-    except Exception: t_prompt = None
-    try: t_output = client.count_tokens(text or "")
-    except Exception: t_output = None
+    # JSON-only variants set response_mime_type
+    chunks = client.generate_stream(
+        rendered["prompt"],
+        system_instruction=rendered["system"],
+        temperature=temp,
+        max_output_tokens=max_tok,
+        response_mime_type=rendered["mime"],
+    )
+
+    # token stats (prompt + output) come back with the response (on the last
+    # chunk); only fall back to a (memoized) count_tokens call if missing
+    final = SimpleNamespace(usage_metadata=None, cache_hit=False)
+    t_first = None
+
+    def texts():
+        nonlocal t_first
+        for chunk in chunks:
+            if t_first is None:
+                t_first = time.perf_counter()
+            final.usage_metadata = getattr(chunk, "usage_metadata", None) or final.usage_metadata
+            final.cache_hit = final.cache_hit or getattr(chunk, "cache_hit", False)
+            yield chunk.text or ""
+
+    # show tokens as they arrive, then clear: the result card renders the final text
+    t0 = time.perf_counter()  # the stream is lazy, so the request starts in write_stream
+    live = st.empty()
+    with live.container():
+        text = st.write_stream(texts())
+    live.empty()
+    latency = time.perf_counter() - t0
+
+    metrics = usage_metrics(final)
+    if metrics["prompt_tokens"] is None:
+        try: metrics["prompt_tokens"] = client.count_tokens(rendered["prompt"])
+        except Exception: pass
 
     return {
         "variant": variant["id"],
@@ -99,22 +119,18 @@ def call_model(variant: Dict[str, Any], case: Dict[str, Any], temp: float, max_t
         "prompt": rendered["prompt"],
         "system": variant.get("system"),
         "output": text or "",
-        "prompt_tokens": t_prompt,
-        "output_tokens": t_output,
+        "latency_ms": round(latency * 1000, 1),
+        "ttft_ms": round((t_first - t0) * 1000, 1) if t_first is not None else None,
+        **metrics,
     }
 
 def csv_from_rows(rows: List[Dict[str, Any]]) -> str:
-    cols = ["variant", "title", "prompt_tokens", "output_tokens", "output"]
-    s = StringIO(); s.write(",".join(cols) + "\n")
-    for r in rows:
-        vals = [
-            r["variant"],
-            r.get("title",""),
-            str(r.get("prompt_tokens","") or ""),
-            str(r.get("output_tokens","") or ""),
-            json.dumps((r.get("output","") or "").replace("\n"," ").strip()),
-        ]
-        s.write(",".join(vals) + "\n")
+    cols = ["variant", "title", "prompt_tokens", "output_tokens", "latency_ms", "cache_hit", "output"]
+    s = StringIO()
+    # csv quotes commas/quotes/newlines in titles and outputs properly
+    w = csv.DictWriter(s, fieldnames=cols, restval="", extrasaction="ignore")
+    w.writeheader()
+    w.writerows({**r, "output": (r.get("output","") or "").strip()} for r in rows)
     return s.getvalue()
 
 # ------------------------------------------------------------------------------
@@ -174,7 +190,7 @@ if not (os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")):
     st.stop()
     
 model_name = defaults.get("model") or os.getenv("GEMINI_MODEL") or "gemini-2.0-flash"
-client = GeminiClient(model=model_name)
+client = get_client(model_name)
 
 left, right = st.columns([1, 1.6], gap="large")
 
@@ -238,6 +254,12 @@ with right:
                 with tabs[2]:
                     pt, ot = res.get("prompt_tokens"), res.get("output_tokens")
                     st.write(f"**Prompt tokens:** {pt if pt is not None else '—'}  |  **Output tokens:** {ot if ot is not None else '—'}")
+                    ttft = res.get("ttft_ms")
+                    st.write(
+                        f"**Latency:** {res['latency_ms']} ms  |  "
+                        f"**First token:** {ttft if ttft is not None else '—'} ms  |  "
+                        f"**Cached:** {'yes' if res.get('cache_hit') else 'no'}"
+                    )
 
                 with tabs[3]:
                     st.download_button(